@@ -0,0 +1,275 @@
+//Native hamming distance search kernel. Built into a shared library by setup.sh and loaded by
+//search-similar-images.py through ctypes. The scripts fall back to a numpy scan when the library
+//is not available, so building it is optional.
+//
+//The entry point dispatches at runtime between an AVX-512 variant (8 hashes per iteration through
+//the VPOPCNTDQ instruction), an AVX2 variant (4 hashes per iteration through the nibble lookup
+//table popcount technique) and a plain scalar loop, depending on what the CPU supports.
+
+#include <stddef.h>
+#include <stdint.h>
+
+#if defined(__x86_64__) && defined(__GNUC__)
+#include <immintrin.h>
+#define HAVE_SIMD 1
+
+//Probe the CPU features once and remember the best available variant: 2 for AVX-512, 1 for AVX2,
+//0 for the scalar fallback.
+static int get_simd_level(void)
+{
+  static int simd_level = -1;
+  if (simd_level < 0) {
+    __builtin_cpu_init();
+    simd_level = __builtin_cpu_supports("avx512vpopcntdq") ? 2 :
+                 __builtin_cpu_supports("avx2") ? 1 : 0;
+  }
+  return simd_level;
+}
+#endif
+
+//Append a pair of row indexes to the match pair array if there is room left, but keep counting
+//either way so the caller can detect overflow, grow the array and retry.
+#define EMIT_PAIR(a, b) \
+  do { \
+    if (pair_count < pair_capacity) { \
+      match_pairs[2 * pair_count] = (int64_t)(a); \
+      match_pairs[2 * pair_count + 1] = (int64_t)(b); \
+    } \
+    pair_count++; \
+  } while (0)
+
+//Scalar search variant, also used to finish the tail elements of the vector variants.
+//Each comparison is a single XOR plus a single hardware population count instruction.
+static size_t search_scalar(uint64_t ref_hash, const uint64_t *hashes, size_t begin,
+                            size_t hash_count, int max_dist, int64_t *match_indexes,
+                            size_t match_count)
+{
+  for (size_t i = begin; i < hash_count; i++) {
+    if (__builtin_popcountll(ref_hash ^ hashes[i]) <= max_dist)
+      match_indexes[match_count++] = (int64_t)i;
+  }
+
+  return match_count;
+}
+
+#ifdef HAVE_SIMD
+
+//AVX2 search variant. There is no AVX2 population count instruction, so the bit counts are built
+//by looking up both nibbles of every XOR mask byte in an in-register table (VPSHUFB), then summing
+//the byte counts of each 64-bit lane with VPSADBW.
+__attribute__((target("avx2")))
+static size_t search_avx2(uint64_t ref_hash, const uint64_t *hashes, size_t hash_count,
+                          int max_dist, int64_t *match_indexes)
+{
+  const __m256i nibble_counts = _mm256_setr_epi8(
+    0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+    0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+  const __m256i nibble_mask = _mm256_set1_epi8(0x0f);
+  const __m256i ref_vec = _mm256_set1_epi64x((int64_t)ref_hash);
+  const __m256i dist_limit = _mm256_set1_epi64x(max_dist);
+
+  size_t match_count = 0;
+  size_t i = 0;
+  for (; i + 4 <= hash_count; i += 4) {
+    __m256i xor_vec = _mm256_xor_si256(_mm256_loadu_si256((const __m256i *)(hashes + i)), ref_vec);
+    __m256i low_counts = _mm256_shuffle_epi8(nibble_counts, _mm256_and_si256(xor_vec, nibble_mask));
+    __m256i high_counts = _mm256_shuffle_epi8(
+      nibble_counts, _mm256_and_si256(_mm256_srli_epi16(xor_vec, 4), nibble_mask));
+    __m256i distances = _mm256_sad_epu8(
+      _mm256_add_epi8(low_counts, high_counts), _mm256_setzero_si256());
+
+    //Build a 4-bit mask with one bit per lane that is farther than the maximum distance, then emit
+    //the indexes of the lanes that are not.
+    int too_far = _mm256_movemask_pd(
+      _mm256_castsi256_pd(_mm256_cmpgt_epi64(distances, dist_limit)));
+    for (int lane = 0; lane < 4; lane++) {
+      if (!(too_far & (1 << lane)))
+        match_indexes[match_count++] = (int64_t)(i + lane);
+    }
+  }
+
+  return search_scalar(ref_hash, hashes, i, hash_count, max_dist, match_indexes, match_count);
+}
+
+//AVX-512 search variant. The VPOPCNTDQ instruction counts the bits of 8 XOR masks at once and the
+//threshold comparison yields the match mask directly.
+__attribute__((target("avx512f,avx512vpopcntdq")))
+static size_t search_avx512(uint64_t ref_hash, const uint64_t *hashes, size_t hash_count,
+                            int max_dist, int64_t *match_indexes)
+{
+  const __m512i ref_vec = _mm512_set1_epi64((int64_t)ref_hash);
+  const __m512i dist_limit = _mm512_set1_epi64(max_dist);
+
+  size_t match_count = 0;
+  size_t i = 0;
+  for (; i + 8 <= hash_count; i += 8) {
+    __m512i distances = _mm512_popcnt_epi64(
+      _mm512_xor_si512(_mm512_loadu_si512((const void *)(hashes + i)), ref_vec));
+    __mmask8 in_range = _mm512_cmple_epu64_mask(distances, dist_limit);
+    while (in_range) {
+      match_indexes[match_count++] = (int64_t)(i + (size_t)__builtin_ctz(in_range));
+      in_range &= in_range - 1;
+    }
+  }
+
+  return search_scalar(ref_hash, hashes, i, hash_count, max_dist, match_indexes, match_count);
+}
+
+#endif
+
+//Find all hashes in an array that are within a maximum hamming distance from a reference hash.
+//Parameters:
+// - ref_hash: The hash that is used as a reference point for the search.
+// - hashes: A contiguous array with one packed 64-bit hash per image row.
+// - hash_count: The amount of hashes in the array.
+// - max_dist: The maximum allowed hamming distance. Hashes farther than this are excluded.
+// - match_indexes: Output array that receives the indexes of the matching hashes. It must have
+//                  room for hash_count entries.
+//Return value: The amount of matches written to match_indexes.
+size_t search_hashes_in_range(uint64_t ref_hash, const uint64_t *hashes, size_t hash_count,
+                              int max_dist, int64_t *match_indexes)
+{
+#ifdef HAVE_SIMD
+  if (get_simd_level() == 2)
+    return search_avx512(ref_hash, hashes, hash_count, max_dist, match_indexes);
+  if (get_simd_level() == 1)
+    return search_avx2(ref_hash, hashes, hash_count, max_dist, match_indexes);
+#endif
+
+  return search_scalar(ref_hash, hashes, 0, hash_count, max_dist, match_indexes, 0);
+}
+
+//Scalar pairwise variant, also used to finish the tail columns of the vector variants.
+static size_t pairs_scalar(const uint64_t *hashes, size_t hash_count, size_t begin_row,
+                           size_t end_row, int max_dist, int64_t *match_pairs,
+                           size_t pair_capacity)
+{
+  size_t pair_count = 0;
+
+  for (size_t i = begin_row; i < end_row; i++) {
+    uint64_t ref_hash = hashes[i];
+    for (size_t j = i + 1; j < hash_count; j++) {
+      if (__builtin_popcountll(ref_hash ^ hashes[j]) <= max_dist)
+        EMIT_PAIR(i, j);
+    }
+  }
+
+  return pair_count;
+}
+
+#ifdef HAVE_SIMD
+
+//AVX2 pairwise variant. Same distance computation as search_avx2, streaming 4 column hashes per
+//iteration against each reference row.
+__attribute__((target("avx2")))
+static size_t pairs_avx2(const uint64_t *hashes, size_t hash_count, size_t begin_row,
+                         size_t end_row, int max_dist, int64_t *match_pairs,
+                         size_t pair_capacity)
+{
+  const __m256i nibble_counts = _mm256_setr_epi8(
+    0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+    0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+  const __m256i nibble_mask = _mm256_set1_epi8(0x0f);
+  const __m256i dist_limit = _mm256_set1_epi64x(max_dist);
+
+  size_t pair_count = 0;
+
+  for (size_t i = begin_row; i < end_row; i++) {
+    uint64_t ref_hash = hashes[i];
+    const __m256i ref_vec = _mm256_set1_epi64x((int64_t)ref_hash);
+
+    size_t j = i + 1;
+    for (; j + 4 <= hash_count; j += 4) {
+      __m256i xor_vec = _mm256_xor_si256(
+        _mm256_loadu_si256((const __m256i *)(hashes + j)), ref_vec);
+      __m256i low_counts = _mm256_shuffle_epi8(
+        nibble_counts, _mm256_and_si256(xor_vec, nibble_mask));
+      __m256i high_counts = _mm256_shuffle_epi8(
+        nibble_counts, _mm256_and_si256(_mm256_srli_epi16(xor_vec, 4), nibble_mask));
+      __m256i distances = _mm256_sad_epu8(
+        _mm256_add_epi8(low_counts, high_counts), _mm256_setzero_si256());
+
+      int too_far = _mm256_movemask_pd(
+        _mm256_castsi256_pd(_mm256_cmpgt_epi64(distances, dist_limit)));
+      if (too_far != 0x0f) {
+        for (int lane = 0; lane < 4; lane++) {
+          if (!(too_far & (1 << lane)))
+            EMIT_PAIR(i, j + (size_t)lane);
+        }
+      }
+    }
+
+    for (; j < hash_count; j++) {
+      if (__builtin_popcountll(ref_hash ^ hashes[j]) <= max_dist)
+        EMIT_PAIR(i, j);
+    }
+  }
+
+  return pair_count;
+}
+
+//AVX-512 pairwise variant, streaming 8 column hashes per iteration against each reference row.
+__attribute__((target("avx512f,avx512vpopcntdq")))
+static size_t pairs_avx512(const uint64_t *hashes, size_t hash_count, size_t begin_row,
+                           size_t end_row, int max_dist, int64_t *match_pairs,
+                           size_t pair_capacity)
+{
+  const __m512i dist_limit = _mm512_set1_epi64(max_dist);
+
+  size_t pair_count = 0;
+
+  for (size_t i = begin_row; i < end_row; i++) {
+    uint64_t ref_hash = hashes[i];
+    const __m512i ref_vec = _mm512_set1_epi64((int64_t)ref_hash);
+
+    size_t j = i + 1;
+    for (; j + 8 <= hash_count; j += 8) {
+      __m512i distances = _mm512_popcnt_epi64(
+        _mm512_xor_si512(_mm512_loadu_si512((const void *)(hashes + j)), ref_vec));
+      __mmask8 in_range = _mm512_cmple_epu64_mask(distances, dist_limit);
+      while (in_range) {
+        EMIT_PAIR(i, j + (size_t)__builtin_ctz(in_range));
+        in_range &= in_range - 1;
+      }
+    }
+
+    for (; j < hash_count; j++) {
+      if (__builtin_popcountll(ref_hash ^ hashes[j]) <= max_dist)
+        EMIT_PAIR(i, j);
+    }
+  }
+
+  return pair_count;
+}
+
+#endif
+
+//Find all pairs of hashes that are within a maximum hamming distance of each other, walking the
+//upper triangle of the pairwise distance matrix so every pair is visited once. Only the rows in
+//[begin_row, end_row) are used as the first element of a pair, which lets the caller process the
+//triangle in chunks and report progress between them.
+//Parameters:
+// - hashes: A contiguous array with one packed 64-bit hash per image row.
+// - hash_count: The amount of hashes in the array.
+// - begin_row, end_row: The range of reference rows to process in this call.
+// - max_dist: The maximum allowed hamming distance. Pairs farther apart than this are excluded.
+// - match_pairs: Output array that receives the matching pairs as interleaved row indexes. It
+//                must have room for pair_capacity pairs (2 * pair_capacity entries).
+//Return value: The total amount of matching pairs found. If this exceeds pair_capacity, the
+//              excess pairs were not written and the caller should retry with a larger array.
+size_t search_hash_pairs(const uint64_t *hashes, size_t hash_count, size_t begin_row,
+                         size_t end_row, int max_dist, int64_t *match_pairs,
+                         size_t pair_capacity)
+{
+#ifdef HAVE_SIMD
+  if (get_simd_level() == 2)
+    return pairs_avx512(hashes, hash_count, begin_row, end_row, max_dist, match_pairs,
+                        pair_capacity);
+  if (get_simd_level() == 1)
+    return pairs_avx2(hashes, hash_count, begin_row, end_row, max_dist, match_pairs,
+                      pair_capacity);
+#endif
+
+  return pairs_scalar(hashes, hash_count, begin_row, end_row, max_dist, match_pairs,
+                      pair_capacity);
+}
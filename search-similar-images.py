@@ -1,130 +1,270 @@
 #!/usr/bin/env -S sh -c '$(dirname $0)/python/bin/python $0 $@'
 
 import argparse
+import ctypes
 import os
+import pickle
 import sys
+import time
 import sqlite3
+import numpy
 import PIL
 import imagehash
 import json
 
-#Perform a recursive depth-first search on all image hashes in the database that are within a
-#maximum hamming distance from a given reference hash.
+#pybktree provides the BK-tree metric index used to answer single queries without scanning every
+#hash. It is optional; without it single queries go through the bulk distance kernel instead.
+try:
+  import pybktree
+except ImportError:
+  pybktree = None
+
+#numba can JIT-compile a distance kernel equivalent to the native one for installs without a C
+#toolchain. Also optional - the kernel priority is native library, then numba, then plain numpy.
+try:
+  import numba
+  import numba.extending
+  import llvmlite.ir
+except ImportError:
+  numba = None
+
+if numba is not None:
+  #Expose the LLVM population count to the JIT, so that it emits one POPCNT instruction per hash
+  #just like the native kernel does.
+  @numba.extending.intrinsic
+  def popcount64(typingctx, value):
+    sig = numba.types.uint64(numba.types.uint64)
+    def codegen(context, builder, signature, args):
+      ctpop = builder.module.declare_intrinsic('llvm.ctpop', [llvmlite.ir.IntType(64)])
+      return builder.call(ctpop, [args[0]])
+    return sig, codegen
+
+  #Mark every hash that is within the maximum hamming distance from the reference in the output
+  #array, processing the hashes on all cores. The compiled code is cached on disk so only the
+  #first run pays for the compilation.
+  @numba.njit(parallel = True, cache = True)
+  def numba_hashes_in_range(packed_hashes, packed_ref, max_dist, in_range):
+    for i in numba.prange(packed_hashes.size):
+      in_range[i] = popcount64(packed_hashes[i] ^ packed_ref) <= max_dist
+
+#Lookup table with the amount of set bits (the "population count") for every possible byte value.
+#Indexing it with a whole numpy array of XOR masks computes hamming distances for all rows at once.
+POPCNT8 = numpy.array([i.bit_count() for i in range(256)], dtype = numpy.uint8)
+
+#Try to load the native hamming search kernel, which is built by setup.sh and compares one packed
+#64-bit hash per hardware population count instruction. If the library is not available, fall back
+#to the vectorized numpy scan.
+try:
+  hamming_lib = ctypes.CDLL(os.path.join(os.path.dirname(sys.argv[0]), 'hamming-search.so'))
+  hamming_lib.search_hashes_in_range.restype = ctypes.c_size_t
+  hamming_lib.search_hashes_in_range.argtypes = (
+    ctypes.c_uint64, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_void_p)
+  hamming_lib.search_hash_pairs.restype = ctypes.c_size_t
+  hamming_lib.search_hash_pairs.argtypes = (
+    ctypes.c_void_p, ctypes.c_size_t, ctypes.c_size_t, ctypes.c_size_t, ctypes.c_int,
+    ctypes.c_void_p, ctypes.c_size_t)
+except OSError:
+  hamming_lib = None
+
+#Check whether a database uses the current packed hash layout (a single 8-byte BLOB per row).
+#Older databases store the hash split in eight TINYINT columns (H0, H1, ... H7) instead; they are
+#migrated by the update script, but stay readable here in the meantime.
 #Parameters:
 # - con: Database connection.
-# - ref_hash: The hash that is used as a reference point for the search.
-# - max_dist: The maximum allowed hamming distance. Images farther than this are excluded.
-# - cand_hash: For recursive calls only - The current candidate hash. A partial hash that is within
-#              the maximum hamming distance and is currently being analyzed.
-# - cand_dist: For recursive calls only - The hamming distance of the current candidate hash.
-#Return value: A set with the filenames of the images of which the hash is within the maximum
-#              hamming distance.
-def search_similar_images(con, ref_hash, max_dist, cand_hash = (), cand_dist = 0):
-  #The hash level represents the current depth of the search. It counts the amount of bytes of the
-  #current candidate hash.
-  hash_level = len(cand_hash)
-
-  #Search for all distinct hahses in the current hash level, using the candidate hash as the fixed
-  #portion for all previous levels.
-  hash_byte_cursor = con.cursor()
-  hash_byte_cursor.execute(
-    'SELECT DISTINCT H{} FROM images{}'.format(
-      hash_level,
-      '' if hash_level == 0 else
-      ' WHERE {}'.format(' AND '.join('H{}=?'.format(i) for i in range(hash_level)))),
-    cand_hash)
-  hash_byte_cursor.row_factory = lambda cur, row: row[0]
-
-  matches = set()
-  for hash_byte in hash_byte_cursor:
-    #Find all bits that differ from the reference hash at the same level by using an XOR mask, then
-    #count the bits that are set and add them to the new candidate distance.
-    different_bits = hash_byte ^ ref_hash[hash_level]
-    new_cand_dist = cand_dist
-    while different_bits > 0:
-      different_bits &= different_bits - 1
-      new_cand_dist += 1
-
-    if new_cand_dist <= max_dist:
-      new_cand_hash = cand_hash + (hash_byte,)
-
-      if hash_level < 7:
-        #Maximum hash level not reached - recurse.
-        matches.update(search_similar_images(con, ref_hash, max_dist, new_cand_hash, new_cand_dist))
-      else:
-        #Maximum hash level reached. Search for all images with the new candidate hash and add them
-        #to the matches.
-        filename_cursor = con.cursor()
-        filename_cursor.execute(
-          'SELECT filename FROM images where {}'.format(
-            ' AND '.join('H{}=?'.format(i) for i in range(8))),
-          new_cand_hash)
-        filename_cursor.row_factory = lambda cur, row: row[0]
-        matches.update(filename_cursor.fetchall())
-
-  return matches
-
-#Recursively merge all sets that share common elements in a given list.
+#Return value: True if the hashes are packed, False for the legacy layout.
+def has_packed_hashes(con):
+  return any(row[1] == 'hash' for row in con.execute('PRAGMA table_info(images)'))
+
+#Load the whole image hash table into memory for bulk processing.
 #Parameters:
-# - set_list: A list containing the sets to merge. It is modified in place, so the result is
-#             returned here as well. This is done in order to save memory on potentially large lists
-#             of sets.
-def merge_sets(set_list):
-  merged_set_list = []  #The resulting merged set list is assembled iteratively
-  recurse = False
-
-  while set_list:
-    #Iterate over the input set list by popping individual sets.
-    s = set_list.pop()
-    merge_count = 0
-
-    #Iterate over the current merged set list.
-    for m in merged_set_list:
-      #If any of the elements of the current set is shared with the current merged set, merge it and
-      #increase the merge count.
-      if s & m:
-        m.update(s)
-        merge_count += 1
-
-    #If the current set wasn't merged with any of the previously merged sets, carry it over.
-    if merge_count == 0:
-      merged_set_list.append(s)
-
-    #If the current set was merged with more than one of the previously merged sets, they will
-    #require to be merged again.
-    if merge_count > 1:
-      recurse = True
-
-  #Having all its elements popped, the input set list is now empty. Populate it with the merged set
-  #list now.
-  set_list.extend(merged_set_list)
-  del merged_set_list
-
-  if recurse:
-    merge_sets(set_list)
+# - con: Database connection.
+#Return value: A tuple with a list of filenames and a numpy array of shape (N, 8) that holds the
+#              hash bytes of the corresponding rows. Rotation hashes are included, so a filename
+#              can appear more than once.
+def load_image_hashes(con):
+  filenames = []
+  hash_bytes = bytearray()
+
+  #Iterate the implicit cursor of execute() directly and index the rows in place - a row factory
+  #would cost one extra Python call per row on this, the biggest query of a search.
+  if has_packed_hashes(con):
+    for row in con.execute('SELECT filename,hash FROM images'):
+      filenames.append(row[0])
+      hash_bytes.extend(row[1])
+  else:
+    for row in con.execute(
+        'SELECT filename,{} FROM images'.format(','.join('H{}'.format(i) for i in range(8)))):
+      filenames.append(row[0])
+      hash_bytes.extend(row[1:9])
+
+  return filenames, numpy.frombuffer(bytes(hash_bytes), dtype = numpy.uint8).reshape(-1, 8)
+
+#Compute the hamming distance between a reference hash and every row of a hash array in a single
+#vectorized pass, then select the rows that are within a maximum hamming distance.
+#Parameters:
+# - hashes: A numpy array of shape (N, 8) with one image hash per row.
+# - ref_hash: The hash that is used as a reference point, as a sequence of 8 bytes.
+# - max_dist: The maximum allowed hamming distance. Rows farther than this are excluded.
+#Return value: A numpy array with the indexes of the matching rows.
+def find_hashes_in_range(hashes, ref_hash, max_dist):
+  if hamming_lib is not None:
+    #Native path. View each 8-byte row as one packed 64-bit word and pack the reference hash with
+    #the same byte order, then let the kernel fill in the matching indexes.
+    packed_hashes = hashes.reshape(-1).view(numpy.uint64)
+    packed_ref = int.from_bytes(bytes(ref_hash), sys.byteorder)
+    match_indexes = numpy.empty(len(hashes), dtype = numpy.int64)
+    match_count = hamming_lib.search_hashes_in_range(
+      packed_ref, packed_hashes.ctypes.data, len(hashes), max_dist, match_indexes.ctypes.data)
+    return match_indexes[:match_count]
+
+  if numba is not None:
+    #JIT path, same packing as the native kernel.
+    packed_hashes = hashes.reshape(-1).view(numpy.uint64)
+    packed_ref = numpy.uint64(int.from_bytes(bytes(ref_hash), sys.byteorder))
+    in_range = numpy.empty(len(hashes), dtype = numpy.bool_)
+    numba_hashes_in_range(packed_hashes, packed_ref, max_dist, in_range)
+    return numpy.flatnonzero(in_range)
+
+  ref = numpy.frombuffer(bytes(ref_hash), dtype = numpy.uint8)
+
+  if max_dist < 8:
+    #The distance of the first byte alone is a lower bound on the full distance, so for the usual
+    #small thresholds it already rules out the vast majority of rows. Filter on it first and only
+    #gather the remaining seven columns for the surviving rows, saving most of the memory traffic.
+    first_byte_dists = POPCNT8[hashes[:, 0] ^ ref[0]]
+    candidates = numpy.flatnonzero(first_byte_dists <= max_dist)
+    distances = (first_byte_dists[candidates]
+                 + POPCNT8[hashes[candidates, 1:] ^ ref[1:]].sum(axis = 1))
+    return candidates[distances <= max_dist]
+
+  distances = POPCNT8[hashes ^ ref].sum(axis = 1)
+  return numpy.flatnonzero(distances <= max_dist)
+
+#Compute the hamming distance between two BK-tree items, which pair a packed 64-bit hash with the
+#index of its table row. Defined at module level so that cached trees can be unpickled.
+#Parameters:
+# - item_a, item_b: The items to compare, as (packed hash, row index) tuples.
+#Return value: The hamming distance between the hashes of both items.
+def hash_item_distance(item_a, item_b):
+  return (item_a[0] ^ item_b[0]).bit_count()
+
+#Build a BK-tree over all image hashes, or load it from a cache file if one matching the current
+#database contents exists. The tree prunes whole branches whose distance bound exceeds the search
+#radius, so lookups touch far fewer hashes than a full scan - but building it costs more than one
+#scan, hence the cache.
+#Parameters:
+# - database: The pathname of the database, used to locate the cache file and to detect staleness.
+# - hashes: A numpy array of shape (N, 8) with one image hash per row, as loaded by
+#           load_image_hashes.
+#Return value: A BK-tree with one (packed hash, row index) item per row.
+def load_hash_tree(database, hashes):
+  cache_file = database + '.bktree'
+  db_mtime = os.path.getmtime(database)
+
+  #Use the cached tree if it was built from the database in its current state.
+  try:
+    with open(cache_file, 'rb') as f:
+      cached_mtime, tree = pickle.load(f)
+    if cached_mtime == db_mtime:
+      return tree
+  except (OSError, pickle.UnpicklingError, EOFError):
+    pass
+
+  tree = pybktree.BKTree(
+    hash_item_distance,
+    [(int.from_bytes(bytes(row), sys.byteorder), index) for index, row in enumerate(hashes)])
+
+  #Cache the tree for the next run. Failing to write the cache is not an error.
+  try:
+    with open(cache_file, 'wb') as f:
+      pickle.dump((db_mtime, tree), f)
+  except OSError:
+    pass
+
+  return tree
+
+#Find the root representative of an element in a union-find forest, compressing the traversed path
+#along the way so later lookups are nearly constant time.
+#Parameters:
+# - parent: A dictionary that maps every known element to its parent element. Roots map to
+#           themselves.
+# - element: The element of which to find the root. Must be present in the forest.
+#Return value: The root element of the group that contains the given element.
+def find_group_root(parent, element):
+  root = element
+  while parent[root] != root:
+    root = parent[root]
+
+  #Path compression - point every element that was traversed directly at the root.
+  while parent[element] != root:
+    parent[element], element = root, parent[element]
+
+  return root
+
+#Union the groups of the filenames of two matching hash rows in a union-find forest. Pairs of rows
+#that belong to the same file (rotations of one image) are ignored, so every group in the forest
+#ends up with at least two files.
+#Parameters:
+# - parent: The union-find parent dictionary, as used by find_group_root.
+# - filenames: A list with the filename of every hash row.
+# - row_a, row_b: The indexes of the matching rows.
+def union_match_pair(parent, filenames, row_a, row_b):
+  filename_a = filenames[row_a]
+  filename_b = filenames[row_b]
+  if filename_a == filename_b:
+    return
+
+  parent.setdefault(filename_a, filename_a)
+  parent.setdefault(filename_b, filename_b)
+  root_a = find_group_root(parent, filename_a)
+  root_b = find_group_root(parent, filename_b)
+  if root_a != root_b:
+    parent[root_b] = root_a
+
+#The earliest time at which show_progress may redraw the bar again.
+progress_next_time = 0.0
 
 #Print a simple ascii progress bar. Reprints the bar on the same line if the operation hasn't
-#finished. Prints a newline when the operation is finished.
+#finished. Prints a newline when the operation is finished. Intermediate redraws are rate limited,
+#as the bar can be fed from a fast loop and terminal writes may block.
 #Parameters:
 # - current: An integer representing the amount of operations performed already.
 # - total: An integer representing the total amount of operations.
 def show_progress(current, total):
+  global progress_next_time
+
+  #Redraw at most every 100 ms; only the final state must always be shown.
+  now = time.monotonic()
+  if current < total and now < progress_next_time:
+    return
+  progress_next_time = now + 0.1
+
   total_width = 70  #This is the proper bar width, not counting surrounding characters
   current_width = total_width * current // total
-  print('\r[{}{}] {}%'.format(
-      '=' * current_width,
-      '-' * (total_width - current_width),
-      100 * current // total),
-    end='' if current < total else '\n',
-    file = sys.stderr)
+  sys.stderr.write('\r[{}{}] {}%{}'.format(
+    '=' * current_width,
+    '-' * (total_width - current_width),
+    100 * current // total,
+    '' if current < total else '\n'))
+  sys.stderr.flush()
 
 #Perform a single image search on the database for similar images, then print all matches.
-def do_single_search(con, image_file, max_dist, json_output):
+def do_single_search(con, database, image_file, max_dist, json_output):
   img = PIL.Image.open(image_file)
-  string_hash = str(imagehash.phash(img))
-  tuple_hash = tuple(int(string_hash[i: i+2], 16) for i in range(0, len(string_hash), 2))
+  ref_hash = bytes.fromhex(str(imagehash.phash(img)))
 
-  matches = search_similar_images(con, tuple_hash, max_dist)
+  #One sequential load of the table (either layout) followed by an in-memory distance pass beats
+  #descending the legacy prefix indexes, which issued one small query per candidate prefix.
+  filenames, hashes = load_image_hashes(con)
+  if pybktree is not None:
+    #Query the cached BK-tree, which visits only the branches that can contain a match.
+    ref_item = (int.from_bytes(ref_hash, sys.byteorder), None)
+    matches = set(
+      filenames[item[1]] for _, item in load_hash_tree(database, hashes).find(
+        ref_item, max_dist))
+  else:
+    #Scan the whole table through the bulk distance kernel.
+    matches = set(filenames[i] for i in find_hashes_in_range(hashes, ref_hash, max_dist))
 
   #Format and print the results.
   if json_output:
@@ -140,39 +280,63 @@ def do_single_search(con, image_file, max_dist, json_output):
 #Parameters:
 # - max_dist: The maximum allowed hamming distance. Images are grouped by coalescing chains.
 def do_full_search(con, max_dist, json_output):
-  #Obtain the amount of distinct images in the table.
-  image_total = con.execute('SELECT COUNT(DISTINCT filename) FROM images').fetchone()[0]
-
-  #There can be up to 4 hashes for each image (one per rotation). Get only one of those hashes, as
-  #searching for rotations is redundant.
-  image_cursor = con.cursor()
-  image_cursor.execute(
-    'SELECT filename,{0} FROM '
-      '(SELECT filename,{0},ROW_NUMBER() OVER (PARTITION BY filename) AS row_num FROM images) '
-    'WHERE row_num=1'.format(
-      ','.join('H{}'.format(i) for i in range(8))))
-  image_cursor.row_factory = lambda cur, row: (row[0], row[1:9])
-
-  #Iterate for every search result.
-  image_count = 0
-  match_list = []
-  for filename, ref_hash in image_cursor:
-    show_progress(image_count, image_total)
-    image_count += 1
-
-    #Look for similar images to this one. Note that this will always include the reference image, as
-    #its hash was taken from the same table.
-    matches = search_similar_images(con, ref_hash, max_dist)
-
-    #Check whether the matches contain more than the reference image itself (that is wether the
-    #image is similar to any other one). If so add them to the match list.
-    if len(matches) > 1:
-      match_list.append(matches)
-
-  show_progress(image_count, image_total)   #Finalize progress reporting
-
-  #Merge all match sets (coalesces chains).
-  merge_sets(match_list)
+  #Load the whole hash table once, then walk the upper triangle of the pairwise distance matrix:
+  #every pair of rows is compared exactly once and each matching pair feeds straight into the
+  #union-find forest, which coalesces the similarity chains as they arrive.
+  filenames, hashes = load_image_hashes(con)
+  row_total = len(hashes)
+  parent = {}
+
+  show_progress(0, row_total)
+  if hamming_lib is not None:
+    #Native path. The triangle is processed in chunks of reference rows, so that progress can be
+    #reported in between and the pair buffer can be drained. If a chunk produces more pairs than
+    #the buffer can hold, the buffer is grown and the chunk retried.
+    packed_hashes = hashes.reshape(-1).view(numpy.uint64)
+    pair_capacity = max(4096, 2 * row_total)
+    pair_buffer = numpy.empty(2 * pair_capacity, dtype = numpy.int64)
+    row = 0
+    while row < row_total:
+      chunk_end = min(row + 4096, row_total)
+      pair_count = hamming_lib.search_hash_pairs(
+        packed_hashes.ctypes.data, row_total, row, chunk_end, max_dist,
+        pair_buffer.ctypes.data, pair_capacity)
+
+      if pair_count > pair_capacity:
+        pair_capacity = pair_count
+        pair_buffer = numpy.empty(2 * pair_capacity, dtype = numpy.int64)
+        continue
+
+      for pair_index in range(pair_count):
+        union_match_pair(
+          parent, filenames, pair_buffer[2 * pair_index], pair_buffer[2 * pair_index + 1])
+
+      row = chunk_end
+      show_progress(row, row_total)
+  else:
+    #Vectorized fallback. Compare the rows tile against tile, keeping only the upper triangle of
+    #the diagonal tiles so no pair is visited twice.
+    tile = 1024
+    for tile_start in range(0, row_total, tile):
+      tile_rows = hashes[tile_start:tile_start + tile]
+      for other_start in range(tile_start, row_total, tile):
+        other_rows = hashes[other_start:other_start + tile]
+        distances = POPCNT8[tile_rows[:, None, :] ^ other_rows[None, :, :]].sum(axis = 2)
+
+        pair_rows, pair_cols = numpy.nonzero(distances <= max_dist)
+        pair_rows += tile_start
+        pair_cols += other_start
+        in_triangle = pair_rows < pair_cols
+        for row_a, row_b in zip(pair_rows[in_triangle], pair_cols[in_triangle]):
+          union_match_pair(parent, filenames, row_a, row_b)
+
+      show_progress(min(tile_start + tile, row_total), row_total)
+
+  #Collect the union-find groups into the final match list.
+  groups = {}
+  for filename in parent:
+    groups.setdefault(find_group_root(parent, filename), set()).add(filename)
+  match_list = list(groups.values())
 
   #Format and print the results.
   if json_output:
@@ -215,8 +379,16 @@ if args.hamming_dist > 16:
 #Create a database connection.
 con = sqlite3.connect(args.database)
 
+#Read oriented settings: a 256 MB page cache, in-memory temporaries, and memory mapping of up to
+#1 GB of the database file, so the bulk hash load comes straight out of the page cache instead of
+#issuing a read() per database page.
+con.executescript(
+  'PRAGMA cache_size=-262144;'
+  'PRAGMA temp_store=MEMORY;'
+  'PRAGMA mmap_size=1073741824;')
+
 #Do a single image search if an image filename was provided. Do a full search otherwise.
 if args.image_file:
-  do_single_search(con, args.image_file, args.hamming_dist, args.json)
+  do_single_search(con, args.database, args.image_file, args.hamming_dist, args.json)
 else:
   do_full_search(con, args.hamming_dist, args.json)
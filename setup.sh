@@ -1,2 +1,3 @@
 python -m venv python
-python/bin/pip install imagehash
+python/bin/pip install imagehash numpy pybktree
+cc -O3 -mpopcnt -shared -fPIC -o hamming-search.so hamming-search.c
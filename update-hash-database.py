@@ -1,12 +1,62 @@
 #!/usr/bin/env -S sh -c '$(dirname $0)/python/bin/python $0 $@'
 
 import argparse
+import concurrent.futures
+import multiprocessing
 import os
 import sys
 import sqlite3
+import numpy
+import scipy.fftpack
 import PIL
 import imagehash
 
+#Hash geometry matching the imagehash.phash defaults: an 8x8 bit hash taken from the low frequency
+#corner of a DCT over a 32x32 downscale of the image.
+PHASH_SIZE = 8
+PHASH_IMG_SIZE = 32
+
+#Compute the perceptual hash of an already downscaled grayscale pixel array. This mirrors the DCT
+#and median thresholding steps of imagehash.phash, so hashing a rotated copy of the same array
+#yields exactly what imagehash.phash would produce for the rotated image.
+#Parameters:
+# - pixels: A numpy array of shape (32, 32) with the grayscale pixel values.
+#Return value: The hash as an 8-byte bytes object.
+def phash_from_pixels(pixels):
+  dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis = 0), axis = 1)
+  dct_low_freq = dct[:PHASH_SIZE, :PHASH_SIZE]
+  return bytes(numpy.packbits(dct_low_freq > numpy.median(dct_low_freq)))
+
+#Compute the perceptual hashes of all four 90 degree rotations of an image file. This is the
+#processor intensive part of the update, so it runs in worker processes.
+#Parameters:
+# - path: The pathname of the image file.
+#Return value: A set with the hashes of every rotation, each as an 8-byte bytes object. Images
+#              with rotational symmetry produce less than four hashes. None is returned if the
+#              file is not an image.
+def compute_rotation_hashes(path):
+  try:
+    img = PIL.Image.open(path)
+  except PIL.UnidentifiedImageError:
+    return None  #Ignore files that are not images
+
+  hashes = set()  #Use a set to reduce the hashes of images with rotational symmetry
+
+  #The grayscale conversion is pointwise, so it commutes with rotation exactly: do it once at full
+  #resolution instead of once per rotation, and produce the rotations with exact pixel transposes
+  #rather than the affine rotate(). The downscale to 32x32 has to stay per rotation - its
+  #resampling passes round differently per orientation, so deriving the rotated hashes from a
+  #single downscale drifts a few bits and would miss rotated duplicates at small hamming
+  #distances.
+  gray = img.convert('L')
+  for orientation in (None, PIL.Image.Transpose.ROTATE_90, PIL.Image.Transpose.ROTATE_180,
+                      PIL.Image.Transpose.ROTATE_270):
+    rotated = gray if orientation is None else gray.transpose(orientation)
+    hashes.add(phash_from_pixels(
+      numpy.asarray(rotated.resize((PHASH_IMG_SIZE, PHASH_IMG_SIZE), imagehash.ANTIALIAS))))
+
+  return hashes
+
 #Create an argument parser and parse all arguments.
 parser = argparse.ArgumentParser(description = 'Compute perceptual hashes for all images in a '
                                                'given directory and add them to a local database. '
@@ -26,56 +76,91 @@ args = parser.parse_args()
 #Create a database connection, then update the schema if needed.
 con = sqlite3.connect(args.database)
 
+#Batch oriented settings: write-ahead logging avoids a journal fsync per transaction (note that
+#WAL creates -wal/-shm files next to the database while connections are open), relaxed
+#synchronization defers the remaining fsyncs to checkpoints, temporary data stays in memory and a
+#large page cache plus memory mapping speed up the migration and duplicate checks.
+con.executescript(
+  'PRAGMA journal_mode=WAL;'
+  'PRAGMA synchronous=NORMAL;'
+  'PRAGMA temp_store=MEMORY;'
+  'PRAGMA cache_size=-262144;'
+  'PRAGMA mmap_size=1073741824;')
+
 schema_cursor = con.cursor();
 
 #Uncomment in order to manually delete all perceptual hashes.
 # schema_cursor.execute('DROP TABLE images')
 
-#Uncomment in order to manually delete all indexes.
-# for i in range(8):
-#   schema_cursor.execute('DROP INDEX hash_level_{}'.format(i))
-
-#Create a table with filenames (not paths) and hashes split in individual octets (H0, H1, ... H7)
-schema_cursor.execute(
-  'CREATE TABLE IF NOT EXISTS images(filename STRING NOT NULL, {})'.format(
-    ', '.join('H{} TINYINT'.format(i) for i in range(8))))
-
-#Create indexes for all hash tuples in the form (H0), (H0, H1), (H0, H1, H2), etc.
-for i in range(8):
-  schema_cursor.execute(
-    'CREATE INDEX IF NOT EXISTS hash_level_{} ON images({})'.format(
-    i,
-    ', '.join('H{}'.format(j) for j in range(i+1))))
-
-#Iterate for every image in the target directory.
-for filename in os.listdir(args.images_path[0]):
-  #Check whether the file is in the images table.
-  query_cursor = con.cursor()
-  query_cursor.execute('SELECT 1 FROM images WHERE filename = ? LIMIT 1', (filename,))
-  if query_cursor.fetchone() is None:
-    #Not in the table. Load it.
-    path = os.path.join(args.images_path[0], filename)
-    try:
-      img = PIL.Image.open(path)
-    except PIL.UnidentifiedImageError:
-      print('Not an image file: {}'.format(filename))
-      continue  #Ignore files that are not images
-
-    #Calculate the hash for every 90 degreee rotation of this image, then structure it as individual
-    #bytes in a tuple.
-    hashes = set()  #Use a set to reduce the hashes of images with rotational symmetry
-    for angle in range(0, 360, 90):
-      string_hash = str(imagehash.phash(img.rotate(angle, expand = True)))
-      tuple_hash = tuple(int(string_hash[i: i+2], 16) for i in range(0, len(string_hash), 2))
-      hashes.update(set((tuple_hash,)))
-
-    #Store every unique hash in the images table.
-    insert_cursor = con.cursor()
-    for h in hashes:
-      insert_cursor.execute(
-        'INSERT INTO images(filename,{}) VALUES ({})'.format(
-          ','.join('H{}'.format(i) for i in range(8)),
-          ','.join(('?') * 9)),
-        (filename,) + h)
+#Older databases store each hash split in eight TINYINT columns (H0, H1, ... H7), with one index
+#per column prefix combination. Those eight indexes multiplied the insert cost and roughly doubled
+#the database size, and the searches now scan the table in bulk instead of descending the
+#prefixes. Migrate such databases to the packed layout below.
+legacy_columns = set(
+  row[1] for row in schema_cursor.execute('PRAGMA table_info(images)').fetchall())
+if 'H0' in legacy_columns:
+  print('Migrating database to the packed hash layout', file = sys.stderr)
+  legacy_rows = [
+    (row[0], bytes(row[1:9]))
+    for row in con.execute('SELECT filename,{} FROM images'.format(
+      ','.join('H{}'.format(i) for i in range(8))))]
+  schema_cursor.execute('DROP TABLE images')  #Also drops the old indexes
+
+#Create a table with filenames (not paths) and the hash packed as a single 8-byte BLOB.
+schema_cursor.execute('CREATE TABLE IF NOT EXISTS images(filename STRING NOT NULL, '
+                      'hash BLOB NOT NULL)')
+
+#Create an index on the filenames, so that lookups by name don't scan the whole table.
+schema_cursor.execute('CREATE INDEX IF NOT EXISTS filename_index ON images(filename)')
 
+#Refill the table when migrating from the old layout.
+if 'H0' in legacy_columns:
+  schema_cursor.executemany('INSERT INTO images(filename,hash) VALUES (?,?)', legacy_rows)
+  con.commit()
+
+#Prepare the INSERT statement once. sqlite3 only reuses a compiled statement when the exact same
+#text is executed again, so the string must not be rebuilt inside the loop.
+insert_sql = 'INSERT INTO images(filename,hash) VALUES (?,?)'
+
+#Commit in batches of files instead of after every single one, so that not every file pays for a
+#transaction round-trip to disk.
+commit_batch_size = 500
+pending_files = 0
+
+#Fetch all filenames that are already in the images table with a single query, then collect the
+#files of the target directory that are not among them. This replaces one indexed lookup per
+#directory entry with an in-memory set test. Sorting keeps the filesystem reads sequential when
+#the files are hashed below.
+existing_filenames = set(
+  row[0] for row in con.execute('SELECT DISTINCT filename FROM images'))
+
+new_filenames = [
+  filename for filename in sorted(os.listdir(args.images_path[0]))
+  if filename not in existing_filenames]
+
+#Hash the new files on all processor cores. Every file is independent, so the work fans out to a
+#process pool while the inserts stay serialized on this process. The pool must use fork workers,
+#as this script has no importable main module for a spawned worker to load.
+executor = concurrent.futures.ProcessPoolExecutor(
+  mp_context = multiprocessing.get_context('fork'))
+hashes_iter = executor.map(
+  compute_rotation_hashes,
+  (os.path.join(args.images_path[0], filename) for filename in new_filenames),
+  chunksize = 16)
+
+for filename, hashes in zip(new_filenames, hashes_iter):
+  if hashes is None:
+    print('Not an image file: {}'.format(filename))
+    continue
+
+  #Store every unique hash in the images table with a single bulk insert, packed as a BLOB.
+  con.executemany(insert_sql, [(filename, h) for h in hashes])
+
+  pending_files += 1
+  if pending_files >= commit_batch_size:
     con.commit()
+    pending_files = 0
+
+#Commit the last, possibly partial batch, then release the worker processes.
+con.commit()
+executor.shutdown()